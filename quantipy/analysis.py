@@ -1,16 +1,84 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import pathlib
+import shutil
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+# Timeframes after which the effect of a change is determined, in days
+HORIZONS = {"1D": 1, "1W": 7, "4W": 28, "12W": 84, "26W": 182, "52W": 364}
+NS_PER_DAY = 86_400_000_000_000
+
+# Version of the data in the cache, increase when 'read_data' changes
+CACHE_VERSION = 2
+
+
+def _as_ns(dates: pd.DatetimeIndex) -> np.ndarray:
+    """ Return the given dates as nanoseconds since the epoch. """
+
+    return dates.to_numpy().astype("datetime64[ns]").view(np.int64)
+
+
+def _effect_numpy(dates, closes, starts, olds, last, horizons):
+    """Determine the effect after each timeframe for each start date.
+
+    Returns the effect in percentages and whether the date after the
+    timeframe is available. Dates are given in nanoseconds, the effect
+    is based on the first close on or after the start plus timeframe.
+    """
+
+    targets = starts[:, None] + horizons
+    pos = dates.searchsorted(targets, side="left")
+    found = (targets <= last) & (pos < len(dates))
+
+    new = closes[np.minimum(pos, len(dates) - 1)]
+    return (new - olds[:, None]) / olds[:, None] * 100, found
+
+
+def _effect_loop(dates, closes, starts, olds, last, horizons):
+    """Determine the effect after each timeframe for each start date.
+
+    Same as '_effect_numpy', written as a loop to be compiled by numba.
+    """
+
+    out = np.empty((len(starts), len(horizons)))
+    found = np.zeros((len(starts), len(horizons)), dtype=np.bool_)
+
+    for i in prange(len(starts)):
+        for h in range(len(horizons)):
+            target = starts[i] + horizons[h]
+            pos = np.searchsorted(dates, target)
+
+            if target <= last and pos < len(dates):
+                out[i, h] = (closes[pos] - olds[i]) / olds[i] * 100
+                found[i, h] = True
+            else:
+                out[i, h] = np.nan
+
+    return out, found
+
+
+# Use the compiled loop if numba is installed
+if njit is not None:
+    _effect_kernel = njit(parallel=True, cache=True)(_effect_loop)
+else:
+    _effect_kernel = _effect_numpy
+
 
 class DataPreparation:
     """ Data preparation class.
 
     This class reads the data in a given path and prepares it
     for further analysis. The given path should contain .csv files
+    named after the index (e.g. '^GSPC.csv' or 'data^GSPC.csv')
     with stock-market data with at least the following columns:
         - Date
         - Adj close
@@ -23,42 +91,143 @@ class DataPreparation:
         """Initialisation"""
 
         self.path = path
+
+        # Results of 'prepare' per (index, percentile) for the current data
+        self._data_version = 0
+        self._cache_version = 0
+        self._cache_indices = []
+        self._changes_cache = {}
+        self._effects_cache = {}
+
         self.data = self.read_data(self.path)
         self.summary = self.summarise(self.data)
 
-    def read_data(self, path: pathlib.Path) -> dict:
+    @property
+    def data(self) -> dict:
+        """The DataFrames per index as returned by 'read_data'.
+
+        The results of 'prepare' are kept until new data is assigned or
+        read. After changing a DataFrame in place, call 'read_data' or
+        assign the data again (data.data = data.data) to prepare it anew.
+        """
+
+        return self._data
+
+    @data.setter
+    def data(self, data: dict) -> None:
+        self._data = data
+        self._data_version += 1
+
+    def read_data(self, path: pathlib.Path, cache: bool = True) -> dict:
         """Read all the data in a given folder. 
         
         Read all the data in a given directory in a Pathlib format
         and return a python dictionary. The key corresponds to the
         index and the item corresponds to the pandas DataFrame.
+
+        If 'cache' == True, the data is stored in parquet files in
+        the '.cache' folder of the given directory and read from there
+        as long as the files in the directory are unchanged.
         """
 
+        # Results of 'prepare' are outdated once new data is read
+        self._data_version = getattr(self, "_data_version", 0) + 1
+
         # List sources
-        data_sources = [x for x in path.iterdir() if "sources" not in str(x)]
+        if not path.is_dir():
+            raise FileNotFoundError(f"No such directory: '{path}'")
+        data_sources = list(path.glob("*^*.csv"))
 
         # Indices
-        indices = []
-        for source in data_sources:
-            start = str(source).find("^")
-            stop = str(source).find(".csv")
-
-            indices.append(str(source)[start + 1 : stop])
-
-        dataframes = {}
-        dataframes.update(
-            {
-                indices[ix]: pd.read_csv(source, index_col=0)
-                for ix, source in enumerate(data_sources)
-            }
-        )
+        indices = [source.stem.split("^", 1)[1] for source in data_sources]
 
-        for key, data in dataframes.items():
-            data.index = [datetime.strptime(ix, "%Y-%m-%d") for ix in data.index]
-            dataframes[key] = data
+        # Check if the data has been read before
+        cache_folder = self.cache_folder(path, data_sources)
+        if cache and cache_folder.exists():
+            try:
+                return self.read_cache(cache_folder, indices)
+            except (ImportError, OSError, ValueError):
+                pass
+
+        # Read the files in parallel, pandas releases the GIL while parsing
+        with ThreadPoolExecutor(max_workers=min(32, max(1, len(data_sources)))) as ex:
+            data = list(ex.map(self.read_source, data_sources))
+
+        dataframes = dict(zip(indices, data))
+
+        if cache:
+            self.write_cache(cache_folder, dataframes)
 
         return dataframes
 
+    def read_source(self, source: pathlib.Path) -> pd.DataFrame:
+        """Read a single .csv file.
+
+        The returned DataFrame has a chronologically sorted
+        DatetimeIndex, which all lookups by date rely on.
+        """
+
+        data = pd.read_csv(
+            source, index_col=0, parse_dates=True, date_format="%Y-%m-%d"
+        )
+        data.index = pd.to_datetime(data.index)
+
+        return data.sort_index()
+
+    def cache_folder(self, path: pathlib.Path, data_sources: list) -> pathlib.Path:
+        """Return the cache folder for the given sources.
+
+        The name of the folder is a hash of the cache version, the given
+        path and the name and modification time of each source, so any
+        change to the sources or the way they are read results in a
+        different folder.
+        """
+
+        key = (
+            CACHE_VERSION,
+            str(path),
+            tuple(sorted((x.name, x.stat().st_mtime) for x in data_sources)),
+        )
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+
+        return path.joinpath(".cache", digest)
+
+    def read_cache(self, cache_folder: pathlib.Path, indices: list) -> dict:
+        """Read the dictionary with DataFrames from a cache folder."""
+
+        return {
+            index: pd.read_parquet(cache_folder.joinpath(f"{index}.parquet"))
+            for index in indices
+        }
+
+    def write_cache(self, cache_folder: pathlib.Path, dataframes: dict) -> None:
+        """Write the dictionary with DataFrames to a cache folder.
+
+        Each DataFrame is written to its own parquet file, so the columns
+        and dtypes of each index are kept as they are. Cache folders of
+        outdated sources are removed. Caching is skipped if no parquet
+        engine (pyarrow or fastparquet) is installed or if the cache
+        folder can not be written to.
+        """
+
+        if not dataframes:
+            return
+
+        try:
+            for stale in cache_folder.parent.glob("*"):
+                if stale == cache_folder:
+                    continue
+                elif stale.is_dir():
+                    shutil.rmtree(stale)
+                else:
+                    stale.unlink()
+
+            cache_folder.mkdir(parents=True, exist_ok=True)
+            for index, data in dataframes.items():
+                data.to_parquet(cache_folder.joinpath(f"{index}.parquet"))
+        except (ImportError, OSError):
+            pass
+
     def summarise(self, dataframes: dict) -> pd.DataFrame:
         """Summarise the available data.
         
@@ -69,18 +238,23 @@ class DataPreparation:
         lowest close (Min) and highest close (Max).
         """
 
-        summary = {"Index": [], "First": [], "Last": [], "Min": [], "Max": []}
-
-        for index in dataframes:
-            df = dataframes[index]
-
-            summary["Index"].append(index)
-            summary["First"].append(min(df.index))
-            summary["Last"].append(max(df.index))
-            summary["Min"].append(min(df["Adj Close"].values))
-            summary["Max"].append(max(df["Adj Close"].values))
-
-        return pd.DataFrame.from_dict(summary).set_index("Index")
+        if not dataframes:
+            return pd.DataFrame(
+                columns=["First", "Last", "Min", "Max"],
+                index=pd.Index([], name="Index"),
+            )
+
+        data = pd.concat(
+            {index: df[["Adj Close"]] for index, df in dataframes.items()},
+            names=["Index", "Date"],
+        ).reset_index()
+
+        return data.groupby("Index", sort=False).agg(
+            First=("Date", "min"),
+            Last=("Date", "max"),
+            Min=("Adj Close", "min"),
+            Max=("Adj Close", "max"),
+        )
 
     def determine_change(
         self, dataframe: pd.DataFrame, clean: bool = True
@@ -89,21 +263,25 @@ class DataPreparation:
         
         Add a column 'Change' to the given dataframe. This is the 
         change between two subsequent 'adjusted closes' in percentages.
-        If 'clean' == True, the values without data will be filled with
-        by linearly interpolating between the surrounding datapoints.
+        If 'clean' == True, the changes and adjusted closes without data
+        will be filled by linearly interpolating between the surrounding
+        datapoints.
         """
 
-        closes = dataframe["Adj Close"].values
-        changes = [0]
+        closes = dataframe["Adj Close"].to_numpy()
 
-        for ix, new in enumerate(closes[1::]):
-            old = closes[ix]
-            changes.append((new - old) / old * 100)
+        # First date has no previous close, the remainder is vectorised.
+        # Single precision is plenty for a change in percentages.
+        changes = np.empty(len(closes), dtype=np.float32)
+        changes[0] = 0.0
+        np.divide(np.diff(closes), closes[:-1], out=changes[1:])
+        changes[1:] *= 100.0
 
         dataframe["Change"] = changes
 
         if clean:
-            dataframe.interpolate(method="linear", inplace=True)
+            for column in ["Adj Close", "Change"]:
+                dataframe[column] = dataframe[column].interpolate(method="linear")
 
         return dataframe
 
@@ -115,8 +293,9 @@ class DataPreparation:
         return a dictionary with nested dictionaries. The keys of the
         dictionary correspond to the given indices. The nested dictionary
         has the keys Data, P and Dates. With corresponding items respectively
-        array with the sorted changes, value for the given percentile and the
-        dates on which the larges changes occured.
+        array with the changes partitioned around the given percentile, value
+        for the given percentile and the dates on which the larges changes
+        occured.
         
         If the given percentile is equal to or below 50, the largest 
         negative changes are returned. If the given percentile is 
@@ -124,107 +303,98 @@ class DataPreparation:
         """
 
         changes = {}
-        changes.update(
-            {
-                ix: {"Data": np.sort(data.Change.values)}
-                for ix, data in dataframes.items()
-            }
-        )
 
-        for key in changes:
-            P = np.percentile(changes[key]["Data"], percentile)
-            df = dataframes[key]
+        for key, data in dataframes.items():
+            values = data["Change"].to_numpy()
+            P = np.quantile(values, percentile / 100)
 
             if percentile <= 50:
-                df = df[df["Change"] <= P]
+                mask = values <= P
             else:
-                df = df[df["Change"] > P]
+                mask = values > P
+
+            # Only the split at the percentile is needed, not a full sort
+            split = min(int(percentile / 100 * len(values)), len(values) - 1)
 
-            changes[key][f"P{percentile}"] = P
-            changes[key]["Dates"] = df.index
+            changes[key] = {
+                "Data": np.partition(values, split),
+                f"P{percentile}": P,
+                "Dates": data.index[mask],
+            }
 
         return changes
 
     def determine_effect(
-        self, dataframe: pd.DataFrame, changes: dict, index: str
+        self,
+        dataframe: pd.DataFrame,
+        changes: dict,
+        index: str,
+        effects: dict = None,
+        offset: int = 0,
     ) -> dict:
         """Check the effect of the given changes.
         
         Check the effect of the large declines or rises of the index
         after a specified timeframe. The effect is determined after 
         1 day, 1 week, 1 month, 3 months, 6 months and 1 year.
-        """
-
-        # Lists to return
-        effect = {
-            "Index": [],
-            "Date": [],
-            "Close": [],
-            "Drop": [],
-            "1D": [],
-            "1W": [],
-            "4W": [],
-            "12W": [],
-            "26W": [],
-            "52W": [],
-        }
 
-        # Scroll through all the dates
-        for date in changes["Dates"]:
-
-            # Save the data we have
-            effect["Index"].append(index)
-            effect["Date"].append(date)
-            effect["Close"].append(dataframe.loc[date, "Adj Close"])
-            effect["Drop"].append(dataframe.loc[date, "Change"])
-
-            new_dates = []
-
-            # After 1 day
-            new_dates.append(("1D", date + timedelta(days=1)))
-
-            # After x weeks
-            for week in [1, 4, 12, 26, 52]:
-                new_dates.append((f"{week}W", date + timedelta(days=week * 7)))
-
-            # Check if date is available in dateframe
-            for date in new_dates:
-                date_found = False
-                add = 0
-
-                # date is available
-                if date[1] <= dataframe.index[-1]:
-                    while not date_found:
-                        try:
-                            ix = date[1] + timedelta(days=add)
-                            new = dataframe.loc[ix, "Adj Close"]
-
-                            if new == 0:
-                                add += 1
-                            else:
-                                date_found = True
-
-                        except:
-                            add += 1
+        The effect is written to the arrays in 'effects' starting at
+        position 'offset'. If 'effects' is not given, the arrays are
+        allocated for the given changes only.
+        """
 
-                    old = effect["Close"][-1]
-                    effect[date[0]].append((new - old) / old * 100)
+        # Plain arrays are much faster to index than the DataFrame
+        closes = dataframe["Adj Close"].to_numpy()
+        drops = dataframe["Change"].to_numpy()
+
+        # Dates with a close to look up the effect, sorted chronologically
+        valid = np.isfinite(closes) & (closes != 0)
+        valid_dates = _as_ns(dataframe.index[valid])
+        valid_closes = closes[valid]
+
+        # Position and close of all the dates
+        dates = pd.DatetimeIndex(changes["Dates"])
+        pos = dataframe.index.get_indexer(dates)
+        if (pos < 0).any():
+            raise KeyError(f"Dates not available for {index}: {dates[pos < 0]}")
+        old = closes[pos]
+
+        result, available = _effect_kernel(
+            valid_dates,
+            valid_closes,
+            _as_ns(dates),
+            old,
+            _as_ns(dataframe.index[-1:])[0],
+            np.array(list(HORIZONS.values()), dtype=np.int64) * NS_PER_DAY,
+        )
 
-                # date is not available
-                else:
-                    effect[date[0]].append("N/A")
+        if effects is None:
+            effects = self.allocate_effects(len(dates))
+        rows = slice(offset, offset + len(dates))
 
-        return effect
+        effects["Index"][rows] = index
+        effects["Date"][rows] = dates.to_numpy()
+        effects["Close"][rows] = old
+        effects["Drop"][rows] = drops[pos]
+        # The effect is NaN if the date after the timeframe is not available
+        result[~available] = np.nan
+        for ix, horizon in enumerate(HORIZONS):
+            effects[horizon][rows] = result[:, ix]
 
-    def update_effects(self, effects: dict, effect: dict) -> dict:
-        """ Update the dictionary by given data. """
+        return effects
 
-        assert (
-            effects.keys() == effect.keys()
-        ), "Something went wrong, the keys of the given dictionaries are not the same"
+    def allocate_effects(self, size: int) -> dict:
+        """ Allocate the arrays to store the effect of 'size' changes. """
 
-        for key in effects:
-            effects[key].extend(effect[key])
+        effects = {
+            "Index": np.empty(size, dtype=object),
+            "Date": np.empty(size, dtype="datetime64[ns]"),
+            "Close": np.empty(size, dtype=np.float64),
+            "Drop": np.empty(size, dtype=np.float64),
+        }
+        effects.update(
+            {horizon: np.empty(size, dtype=np.float64) for horizon in HORIZONS}
+        )
 
         return effects
 
@@ -246,29 +416,21 @@ class DataPreparation:
         DataFrame with all available information is returned.
         """
 
-        effects = {
-            "Index": [],
-            "Date": [],
-            "Close": [],
-            "Drop": [],
-            "1D": [],
-            "1W": [],
-            "4W": [],
-            "12W": [],
-            "26W": [],
-            "52W": [],
-        }
-
         if index != "All":
-            effect = self.determine_effect(dataframes[index], changes[index], index)
-            effects = self.update_effects(effects, effect)
+            indices = [index]
+        else:
+            indices = list(dataframes.keys())
 
-        # For all indices
-        for index in dataframes.keys():
-            effect = self.determine_effect(dataframes[index], changes[index], index)
-            effects = self.update_effects(effects, effect)
+        # Allocate the arrays for all indices at once
+        size = sum(len(changes[ix]["Dates"]) for ix in indices)
+        effects = self.allocate_effects(size)
 
-        return pd.DataFrame.from_dict(effects)
+        offset = 0
+        for ix in indices:
+            self.determine_effect(dataframes[ix], changes[ix], ix, effects, offset)
+            offset += len(changes[ix]["Dates"])
+
+        return pd.DataFrame(effects)
 
     def prepare(self, percentile: float, index: str = "All") -> pd.DataFrame:
         """Prepare the data.
@@ -281,6 +443,9 @@ class DataPreparation:
         If the given percentile is equal to or below 50, the largest 
         negative changes are returned. If the given percentile is 
         above 50, the largest positive changes are returned.
+
+        The results are reused for the same percentile and index as long
+        as the data is unchanged, see 'data'.
         """
 
         # Make sure input is correct
@@ -290,12 +455,45 @@ class DataPreparation:
             ), "The specified index is not available in the data"
         assert 0 < percentile <= 100, "Specify a percentile in the interval (0, 100]"
 
-        # Add change column to available data
-        for key, data in self.data.items():
-            self.data[key] = self.determine_change(data)
+        # Add change column to newly read or added data and forget the
+        # results of the previous data. Each DataFrame is updated in place.
+        if self._cache_version != self._data_version:
+            outdated = list(self.data.values())
+        else:
+            outdated = [data for data in self.data.values() if "Change" not in data]
+
+        if (
+            outdated
+            or self._cache_version != self._data_version
+            or self._cache_indices != list(self.data)
+        ):
+            with ThreadPoolExecutor() as ex:
+                list(ex.map(self.determine_change, outdated))
+
+            self._changes_cache.clear()
+            self._effects_cache.clear()
+            self._cache_version = self._data_version
+            self._cache_indices = list(self.data)
 
         # Determine the changes corresponding to the given percentile
-        self.changes = self.biggest_changes(self.data, percentile)
+        missing = {
+            key: data
+            for key, data in self.data.items()
+            if (key, percentile) not in self._changes_cache
+        }
+        if missing:
+            changes = self.biggest_changes(missing, percentile)
+            self._changes_cache.update(
+                {(key, percentile): item for key, item in changes.items()}
+            )
+        self.changes = {
+            key: self._changes_cache[(key, percentile)] for key in self.data
+        }
 
         # Determine the effect of these changes
-        return self.check_effect(self.data, self.changes, index)
+        if (index, percentile) not in self._effects_cache:
+            self._effects_cache[(index, percentile)] = self.check_effect(
+                self.data, self.changes, index
+            )
+
+        return self._effects_cache[(index, percentile)].copy()
@@ -11,7 +11,7 @@ with open('README.md') as readme_file:
 with open('README.md') as history_file:
     history = history_file.read()
 
-requirements = ["pathlib", "pandas", "numpy", "matplotlib", ]
+requirements = ["pathlib", "pandas>=2.0", "numpy", "matplotlib", ]
 
 setup_requirements = ["pytest-runner", ]
 
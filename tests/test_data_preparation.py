@@ -1,4 +1,12 @@
+import os
 import pathlib
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from quantipy import analysis
 from quantipy.analysis import DataPreparation
 
 def test_read_data():
@@ -7,4 +15,221 @@ def test_read_data():
     path = pathlib.Path.cwd()
     test_class = DataPreparation(path.joinpath("data"))
 
-    test_class.prepare(percentile = 0.5)
\ No newline at end of file
+    test_class.prepare(percentile = 0.5)
+
+def write_index(path, index, closes, start="2019-01-01", **columns):
+    """Write a .csv file with the given closes on subsequent business days."""
+
+    dates = pd.bdate_range(start, periods=len(closes))
+    data = pd.DataFrame(
+        {"Date": dates.strftime("%Y-%m-%d"), "Adj Close": closes, **columns}
+    )
+    data.to_csv(path.joinpath(f"data^{index}.csv"), index=False)
+
+
+def test_read_cache(tmp_path, monkeypatch):
+    """Test that the data is read from the cache on a second run."""
+
+    write_index(tmp_path, "AEX", np.linspace(100, 200, 50), Volume=np.arange(50))
+    write_index(tmp_path, "DJI", np.linspace(300, 400, 40))
+    expected = DataPreparation(tmp_path).data
+
+    assert len(list(tmp_path.joinpath(".cache").glob("*/*.parquet"))) == 2
+
+    def read_source(self, source):
+        raise AssertionError("The source should not be read")
+
+    monkeypatch.setattr(DataPreparation, "read_source", read_source)
+    data = DataPreparation(tmp_path).data
+
+    assert list(data) == list(expected)
+    for index in expected:
+        pd.testing.assert_frame_equal(data[index], expected[index])
+
+
+def test_cache_invalidated(tmp_path):
+    """Test that changed sources are read again and old cache files removed."""
+
+    write_index(tmp_path, "AEX", np.linspace(100, 200, 50))
+    DataPreparation(tmp_path)
+
+    source = tmp_path.joinpath("data^AEX.csv")
+    write_index(tmp_path, "AEX", np.linspace(300, 400, 50))
+    os.utime(source, (source.stat().st_atime, source.stat().st_mtime + 10))
+    data = DataPreparation(tmp_path).data
+
+    assert data["AEX"]["Adj Close"].iloc[0] == 300
+    assert len(list(tmp_path.joinpath(".cache").iterdir())) == 1
+
+
+def test_cache_without_parquet_engine(tmp_path, monkeypatch):
+    """Test that the sources are read if no parquet engine is installed."""
+
+    write_index(tmp_path, "AEX", np.linspace(100, 200, 50))
+    DataPreparation(tmp_path)
+
+    def no_engine(*args, **kwargs):
+        raise ImportError("Unable to find a usable engine")
+
+    monkeypatch.setattr(pd, "read_parquet", no_engine)
+    monkeypatch.setattr(pd.DataFrame, "to_parquet", no_engine)
+
+    data = DataPreparation(tmp_path).data
+    assert len(data["AEX"]) == 50
+
+    shutil.rmtree(tmp_path.joinpath(".cache"))
+    data = DataPreparation(tmp_path).data
+    assert len(data["AEX"]) == 50
+    assert not list(tmp_path.joinpath(".cache").glob("*/*.parquet"))
+
+
+def test_summarise_without_data(tmp_path):
+    """Test that an empty folder results in an empty summary."""
+
+    summary = DataPreparation(tmp_path).summary
+
+    assert summary.empty
+    assert list(summary.columns) == ["First", "Last", "Min", "Max"]
+
+
+def test_prepare_cache(tmp_path, monkeypatch):
+    """Test that repeated calls to prepare reuse the results."""
+
+    rng = np.random.default_rng(0)
+    write_index(tmp_path, "AEX", 100 + rng.normal(0, 1, 500).cumsum())
+    write_index(tmp_path, "DJI", 100 + rng.normal(0, 1, 500).cumsum())
+    test_class = DataPreparation(tmp_path)
+
+    calls = []
+    for name in ["determine_change", "biggest_changes", "check_effect"]:
+        method = getattr(DataPreparation, name)
+
+        def counted(self, *args, _method=method, _name=name, **kwargs):
+            calls.append(_name)
+            return _method(self, *args, **kwargs)
+
+        monkeypatch.setattr(DataPreparation, name, counted)
+
+    expected = test_class.prepare(percentile=5)
+    assert calls == ["determine_change"] * 2 + ["biggest_changes", "check_effect"]
+
+    # The cached result is returned as a copy
+    expected.loc[:, "Close"] = 0
+    calls.clear()
+    result = test_class.prepare(percentile=5)
+    assert calls == []
+    assert (result["Close"] != 0).all()
+
+    # Reading the data again clears the cache
+    test_class.data = test_class.read_data(tmp_path)
+    result_new = test_class.prepare(percentile=5)
+    assert calls == ["determine_change"] * 2 + ["biggest_changes", "check_effect"]
+    pd.testing.assert_frame_equal(result, result_new)
+
+
+def test_read_data_missing_folder(tmp_path):
+    """Test that a folder that does not exist is not read as empty data."""
+
+    with pytest.raises(FileNotFoundError):
+        DataPreparation(tmp_path.joinpath("missing"))
+
+
+def test_prepare_missing_close(tmp_path):
+    """Test that a missing close is interpolated and skipped in lookups."""
+
+    closes = 100 + np.random.default_rng(1).normal(0, 1, 500).cumsum()
+    closes[200] = np.nan
+    write_index(tmp_path, "AEX", closes)
+    test_class = DataPreparation(tmp_path)
+
+    result = test_class.prepare(percentile=5)
+    assert result["Close"].notna().all()
+    assert test_class.data["AEX"]["Adj Close"].notna().all()
+
+    # Without cleaning the effect is based on the next available close
+    dataframe = test_class.read_data(tmp_path)["AEX"]
+    dataframe = test_class.determine_change(dataframe, clean=False)
+    changes = {"Dates": dataframe.index[[199]]}
+    effect = test_class.determine_effect(dataframe, changes, "AEX")
+
+    expected = (closes[201] - closes[199]) / closes[199] * 100
+    assert np.isclose(effect["1D"][0], expected)
+
+
+def test_determine_effect_unknown_date(tmp_path):
+    """Test that a date which is not in the data raises a KeyError."""
+
+    write_index(tmp_path, "AEX", np.linspace(100, 200, 50))
+    test_class = DataPreparation(tmp_path)
+    dataframe = test_class.determine_change(test_class.data["AEX"])
+
+    with pytest.raises(KeyError):
+        test_class.determine_effect(
+            dataframe, {"Dates": pd.DatetimeIndex(["1990-01-01"])}, "AEX"
+        )
+
+
+def test_prepare_changed_data(tmp_path):
+    """Test that prepare notices added and reassigned data."""
+
+    rng = np.random.default_rng(2)
+    write_index(tmp_path, "AEX", 100 + rng.normal(0, 1, 500).cumsum())
+    test_class = DataPreparation(tmp_path)
+    result = test_class.prepare(percentile=5)
+
+    # An added index is prepared as well
+    other = tmp_path.joinpath("other")
+    other.mkdir()
+    write_index(other, "DJI", 100 + rng.normal(0, 1, 500).cumsum())
+    test_class.data["DJI"] = test_class.read_source(other.joinpath("data^DJI.csv"))
+
+    result_added = test_class.prepare(percentile=5)
+    assert set(result_added["Index"]) == {"AEX", "DJI"}
+
+    # A change in place is prepared again once the data is assigned again
+    test_class.data["AEX"]["Adj Close"] *= 2
+    test_class.data = test_class.data
+
+    result_changed = test_class.prepare(percentile=5, index="AEX")
+    np.testing.assert_allclose(result_changed["Close"], result["Close"] * 2)
+
+
+def test_effect_kernels(tmp_path, monkeypatch):
+    """Test the compiled and numpy kernels against hand-computed effects."""
+
+    # Business days with a holiday on Monday 2019-01-21 and a zero close
+    dates = pd.bdate_range("2019-01-01", periods=30).drop(pd.Timestamp("2019-01-21"))
+    dataframe = pd.DataFrame(
+        {"Adj Close": 100.0 + np.arange(len(dates))}, index=dates
+    )
+    dataframe.loc["2019-01-09", "Adj Close"] = 0.0
+
+    test_class = DataPreparation(tmp_path)
+    with np.errstate(divide="ignore"):
+        dataframe = test_class.determine_change(dataframe, clean=False)
+    changes = {"Dates": pd.DatetimeIndex(["2019-01-08", "2019-01-18"])}
+
+    def effect(start, end):
+        close = dataframe["Adj Close"]
+        return (close[end] - close[start]) / close[start] * 100
+
+    expected = {
+        # Zero close on 2019-01-09 is skipped
+        "1D": [effect("2019-01-08", "2019-01-10"), effect("2019-01-18", "2019-01-22")],
+        "1W": [effect("2019-01-08", "2019-01-15"), effect("2019-01-18", "2019-01-25")],
+        # Past the last date (2019-02-11)
+        "4W": [effect("2019-01-08", "2019-02-05"), np.nan],
+        "12W": [np.nan, np.nan],
+    }
+
+    results = []
+    for kernel in [analysis._effect_kernel, analysis._effect_numpy]:
+        monkeypatch.setattr(analysis, "_effect_kernel", kernel)
+        result = test_class.determine_effect(dataframe, changes, "AEX")
+
+        for horizon, values in expected.items():
+            np.testing.assert_allclose(result[horizon], values)
+        results.append(result)
+
+    for horizon in analysis.HORIZONS:
+        np.testing.assert_array_equal(results[0][horizon], results[1][horizon])